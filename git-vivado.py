@@ -3,11 +3,12 @@
 import argparse
 import collections
 import enum
-import json
+import functools
 import os
-import pathlib
+import pickle
 import platform
-import shutil
+import stat
+import string
 import subprocess
 import sys
 
@@ -27,6 +28,7 @@ elif "windows" in platform.system().lower():
     PLATFORM = "windows"
 else:
     printerr(f"Error: Unsupported OS: {platform.system()}")
+    sys.exit(ExitCode.FAILURE)
 
 # The items in the config
 CONFIG_ITEMS = {
@@ -38,75 +40,394 @@ CONFIG_ITEMS = {
     "xpr_path":       { "required": False, "default": "proj/{project_name}.xpr" },
 }
 
+def compile_template(template):
+    """
+    Compile a `str.format` style template so that it does not need to be
+    parsed every time it is interpolated.
+
+    # Arguments
+
+    * `template` (str): The template, which may only use plain named fields
+        without a conversion or format spec.
+
+    # Returns
+
+    A function that takes the config dict and returns the interpolated string.
+
+    # Raises
+
+    `ValueError` if the template uses anything other than plain named fields,
+    since the compiled function would not match `str.format` for them.
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is not None and (not field.isidentifier() or spec
+                or conversion is not None):
+            raise ValueError(f"Unsupported field in template: {template}")
+        parts.append((literal, field))
+    return lambda config: "".join(
+            literal + (str(config[field]) if field is not None else "")
+            for literal, field in parts)
+
+# The config items that must be defined by the config files.
+CONFIG_REQUIRED = frozenset(k for k, v in CONFIG_ITEMS.items() if v["required"])
+
+# The default values of the config items that are not required.
+CONFIG_DEFAULTS = {
+    k: v["default"] for k, v in CONFIG_ITEMS.items() if not v["required"]
+}
+
+# The default config values that interpolate other items, compiled once.
+CONFIG_DEFAULT_TEMPLATES = {
+    k: compile_template(v["default"]) for k, v in CONFIG_ITEMS.items()
+    if not v["required"] and "{" in v["default"]
+}
+
 # The encoding for subprocess communication.
 DEFAULT_ENCODING = "utf-8"
 
+# The minimum number of files for which copies are done in parallel.
+PARALLEL_COPY_MIN_FILES = 16
+
 # The configuration base filename.
 CONFIG_FILENAME = "vivado-scripts.json"
 
+# The configuration cache base filename.
+CONFIG_CACHE_FILENAME = "config.pkl"
+
+# The candidate configuration file paths in the order that they are read, and
+# the path of the file that caches the merged configuration.
+if PLATFORM == "linux":
+    if "XDG_CONFIG_HOME" in os.environ:
+        xdg_config_home = os.environ["XDG_CONFIG_HOME"]
+    else:
+        xdg_config_home = os.path.join(os.environ["HOME"], ".config")
+    if "XDG_CACHE_HOME" in os.environ:
+        xdg_cache_home = os.environ["XDG_CACHE_HOME"]
+    else:
+        xdg_cache_home = os.path.join(os.environ["HOME"], ".cache")
+    CONFIG_PATHS = (
+        os.path.join(xdg_config_home, "vivado-scripts", CONFIG_FILENAME),
+        os.path.join(xdg_config_home, CONFIG_FILENAME),
+        os.path.join(os.environ["HOME"], ".vivado-scripts", CONFIG_FILENAME),
+        os.path.join(os.environ["HOME"], "." + CONFIG_FILENAME),
+        CONFIG_FILENAME,
+    )
+    CONFIG_CACHE_PATH = os.path.join(xdg_cache_home, "vivado-scripts",
+            CONFIG_CACHE_FILENAME)
+    # Only the paths are kept in the module namespace
+    del xdg_config_home, xdg_cache_home
+elif PLATFORM == "windows":
+    CONFIG_PATHS = (
+        os.path.join(os.environ["APPDATA"], "vivado-scripts", "vivado-scripts",
+            "config", CONFIG_FILENAME),
+        CONFIG_FILENAME,
+    )
+    # The cache is optional, so only APPDATA is required to be defined
+    CONFIG_CACHE_PATH = os.path.join(
+            os.environ.get("LOCALAPPDATA", os.environ["APPDATA"]),
+            "vivado-scripts", CONFIG_CACHE_FILENAME)
+
+def config_cache_key(paths):
+    """
+    Build the key that identifies a cached configuration. The key changes when
+    any of the configuration files is created, deleted or modified, and when
+    this script is modified, since it defines the defaults and interpolation.
+
+    # Arguments
+
+    * `paths` (tuple<str>): The candidate configuration file paths.
+
+    # Returns
+
+    A tuple of `(path, mtime, size)` for this script and each configuration
+    file that exists.
+    """
+    key = []
+    for path in (__file__,) + paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        key.append((os.path.abspath(path), st.st_mtime_ns, st.st_size))
+    return tuple(key)
+
+def load_config_cache(key):
+    """
+    Load the cached configuration.
+
+    # Arguments
+
+    * `key` (tuple): The key of the current configuration files.
+
+    # Returns
+
+    The cached configuration, or `None` if there is no cache or it is stale.
+    """
+    try:
+        with open(CONFIG_CACHE_PATH, "rb") as f:
+            cache = pickle.load(f)
+        if cache["key"] == key:
+            return cache["config"]
+    except (OSError, EOFError, ValueError, KeyError, TypeError,
+            pickle.UnpicklingError):
+        # A missing, unreadable or malformed cache is treated as stale
+        pass
+    return None
+
+def store_config_cache(key, config):
+    """
+    Store the merged configuration in the cache. Failures are ignored since the
+    cache is only an optimization.
+
+    # Arguments
+
+    * `key` (tuple): The key of the current configuration files.
+    * `config` (dict): The merged configuration.
+    """
+    tmp_path = f"{CONFIG_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(CONFIG_CACHE_PATH), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump({ "key": key, "config": config }, f,
+                    pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CONFIG_CACHE_PATH)
+    except (OSError, pickle.PicklingError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+@functools.lru_cache(maxsize=1)
 def read_config():
+    """
+    Read the configuration files. The result is cached so the files are only
+    read once per run, and the merged configuration is cached on disk until
+    one of the configuration files changes.
+    """
+    key = config_cache_key(CONFIG_PATHS)
+    cached = load_config_cache(key)
+    if cached is not None:
+        return cached
+    # The JSON parser is only needed when the cache is stale. Use the faster
+    # orjson parser when it is installed.
+    try:
+        import orjson as json
+    except ImportError:
+        import json
     config = {}
-    def load_file(*paths):
-        path = os.path.join(*paths)
-        if os.path.isfile(path):
-            try:
-                with open(path) as f:
-                    config.update(json.load(f))
-            except Exception as e:
-                printerr("Error: could not load config: {e}")
+    def load_file(path):
+        try:
+            with open(path, "rb") as f:
+                config.update(json.loads(f.read()))
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            # Missing config files are skipped
+            pass
+        except PermissionError as e:
+            # Opening a directory on Windows is a permission error, and it is
+            # skipped just like any other path that is not a file
+            if not os.path.isdir(path):
+                printerr(f"Error: could not load config {path}: {e}")
                 sys.exit(ExitCode.BAD_CONFIG)
-    if PLATFORM == "linux":
-        if "XDG_CONFIG_HOME" in os.environ:
-            xdg_config_home = os.environ["XDG_CONFIG_HOME"]
-        else:
-            xdg_config_home = os.path.join(os.environ["HOME"], ".config")
-        load_file(xdg_config_home, "vivado-scripts", CONFIG_FILENAME)
-        load_file(xdg_config_home, CONFIG_FILENAME)
-        load_file(os.environ["HOME"], ".vivado-scripts", CONFIG_FILENAME)
-        load_file(os.environ["HOME"], "." + CONFIG_FILENAME)
-        load_file(CONFIG_FILENAME)
-    elif PLATFORM == "windows":
-        load_file(os.environ["APPDATA"], "vivado-scripts", "vivado-scripts", "config", FILENAME)
-        load_file(CONFIG_FILENAME)
+        except Exception as e:
+            printerr(f"Error: could not load config {path}: {e}")
+            sys.exit(ExitCode.BAD_CONFIG)
+    for path in CONFIG_PATHS:
+        load_file(path)
     # Check that the config defined everything, and if not, fill in default
     # values
-    for k, v in CONFIG_ITEMS.items():
+    missing = CONFIG_REQUIRED - config.keys()
+    if missing:
+        for k in sorted(missing):
+            printerr(f"Error: Missing configuration key: {k}")
+        sys.exit(ExitCode.BAD_CONFIG)
+    templates = {}
+    for k, v in CONFIG_DEFAULTS.items():
         if k not in config:
-            if v["required"]:
-                printerr(f"Error: Missing configuration key: {k}")
-                sys.exit(ExitCode.BAD_CONFIG)
-            else:
-                config[k] = v["default"]
+            config[k] = v
+            if k in CONFIG_DEFAULT_TEMPLATES:
+                templates[k] = CONFIG_DEFAULT_TEMPLATES[k]
     c = {}
     for k, v in config.items():
-        c[k] = v.format(**config) if isinstance(v, str) else v
+        # Defaults use their precompiled templates, and otherwise only strings
+        # containing braces need to be interpolated
+        if k in templates:
+            c[k] = templates[k](config)
+        elif isinstance(v, str) and ("{" in v or "}" in v):
+            c[k] = v.format(**config)
+        else:
+            c[k] = v
+    store_config_cache(key, c)
     return c
 
+# The result of running a command with `run_cmd`.
+CmdResult = collections.namedtuple("CmdResult",
+        ["returncode", "stderr"])
+
+# The parsed command line arguments returned by `parse_args`.
+Args = collections.namedtuple("Args",
+        ["func", "config", "project_name", "repo_path", "script_dir",
+            "vivado_path", "vivado_version", "workspace_path", "xpr_path", "sdk"])
+
+def abs_path(path):
+    """
+    Make a path absolute and use forward slashes as the separator, which is
+    what the Tcl scripts expect on every platform.
+    """
+    return os.path.abspath(path).replace("\\", "/")
+
+def copy_files(files):
+    """
+    Copy files along with their metadata. The file contents are copied first,
+    in parallel when there are enough files to make it worthwhile, so that the
+    platform's fast copy is used for the data, and the metadata is copied
+    afterwards in a single pass.
+
+    # Arguments
+
+    * `files` (list<(str, str)>): The `(source, destination)` path pairs.
+    """
+    import shutil
+    if len(files) < PARALLEL_COPY_MIN_FILES:
+        for s, d in files:
+            shutil.copyfile(s, d)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as ex:
+            # Consume the results so that any exception is raised here
+            list(ex.map(lambda f: shutil.copyfile(*f), files))
+    for s, d in files:
+        shutil.copystat(s, d)
+
+def is_up_to_date(src, dest):
+    """
+    Check whether a destination file is an unchanged copy of the source file.
+    Since copies preserve the modification time, a file with the same size and
+    modification time as the source is assumed to be up to date.
+
+    # Arguments
+
+    * `src` (str): The source file path.
+    * `dest` (str): The destination file path.
+    """
+    try:
+        ds = os.stat(dest)
+    except OSError:
+        return False
+    ss = os.stat(src)
+    return ss.st_size == ds.st_size and ss.st_mtime_ns == ds.st_mtime_ns
+
+def is_link(entry):
+    """
+    Check whether a directory entry is a symbolic link, or a junction or other
+    reparse point on Windows.
+
+    # Arguments
+
+    * `entry` (os.DirEntry): The directory entry.
+    """
+    if entry.is_symlink():
+        return True
+    st = entry.stat(follow_symlinks=False)
+    return bool(getattr(st, "st_file_attributes", 0)
+            & stat.FILE_ATTRIBUTE_REPARSE_POINT)
+
+def remove_link(entry):
+    """
+    Remove a link without touching what it points to. On Windows, links to
+    directories and junctions must be removed as directories.
+
+    # Arguments
+
+    * `entry` (os.DirEntry): The directory entry of the link.
+    """
+    st = entry.stat(follow_symlinks=False)
+    if getattr(st, "st_file_attributes", 0) & stat.FILE_ATTRIBUTE_DIRECTORY:
+        os.rmdir(entry.path)
+    else:
+        os.unlink(entry.path)
+
+def remove_stale(dest, dirs, files):
+    """
+    Remove the entries of a destination directory that are no longer in the
+    source directory, or that have a different type than in the source. Links
+    are always removed so that the copy never writes outside the destination.
+
+    # Arguments
+
+    * `dest` (str): The destination directory.
+    * `dirs` (set<str>): The names of the directories in the source directory.
+    * `files` (set<str>): The names of the files in the source directory.
+    """
+    import shutil
+    with os.scandir(dest) as it:
+        for e in it:
+            if is_link(e):
+                remove_link(e)
+            elif e.is_dir():
+                if e.name not in dirs:
+                    shutil.rmtree(e.path)
+            elif e.name not in files:
+                os.remove(e.path)
+
 def copy_dir_contents(src, dest, exit_code=ExitCode.FAILURE):
     """
     Copy the contents of the source directory to the destination directory.
     """
+    # These are only needed for the SDK copy, so they are imported lazily
+    import pathlib
+    import shutil
     # Make sure the source directory exists
     if not os.path.isdir(src):
         printerr(f"Error: {src} must be a directory")
         sys.exit(exit_code)
     # Create the destination directory if it does not exist
     pathlib.Path(dest).mkdir(parents=True, exist_ok=True)
+    # Collect the files that need to be copied, updating the directory
+    # structure on the way. Files that are unchanged since the last copy are
+    # skipped, and anything that is no longer in the source is removed.
+    files = []
+    dirs = []
+    def raise_error(e):
+        # os.walk skips unreadable directories by default, but an incomplete
+        # copy must be reported
+        raise e
+    with os.scandir(src) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    # Links in the destination are replaced by copies so that the copy never
+    # writes outside the destination
+    with os.scandir(dest) as it:
+        links = { e.name: e for e in it if is_link(e) }
+    for e in entries:
+        s = e.path
+        d = os.path.join(dest, e.name)
+        if e.name in links:
+            remove_link(links[e.name])
+        if e.is_dir():
+            for root, subdirs, names in os.walk(s, onerror=raise_error,
+                    followlinks=True):
+                target = os.path.join(d, os.path.relpath(root, s))
+                os.makedirs(target, exist_ok=True)
+                remove_stale(target, set(subdirs), set(names))
+                dirs.append((root, target))
+                for n in sorted(names):
+                    fs = os.path.join(root, n)
+                    fd = os.path.join(target, n)
+                    if not is_up_to_date(fs, fd):
+                        files.append((fs, fd))
+        elif not is_up_to_date(s, d):
+            files.append((s, d))
     # Copy the files
-    for f in sorted(os.listdir(src)):
-        s = os.path.join(src, f)
-        d = os.path.join(dest, f)
-        if os.path.isdir(s):
-            # Delete the target directory before the copy if it already exists
-            if os.path.isdir(d):
-                shutil.rmtree(d)
-            shutil.copytree(s, d)
-        else:
-            shutil.copy2(s, d)
+    copy_files(files)
+    # Copy the directory metadata last, since copying the files changes it
+    for s, d in dirs:
+        shutil.copystat(s, d)
 
 def run_cmd(cmd, encoding=DEFAULT_ENCODING):
     """
-    Run a command as a subprocess.
+    Run a command as a subprocess. The stdout of the subprocess is streamed to
+    the stdout of this process, and the stderr is spooled to a temporary file so
+    that it is never buffered in memory.
 
     # Arguments
 
@@ -118,24 +439,28 @@ def run_cmd(cmd, encoding=DEFAULT_ENCODING):
 
     A named tuple with the following fields:
         - returncode: The returned value from the subproccess.
-        - stderr: The stderr output from the subprocess.
-        - stdout: The stdout output from the subprocess.
+        - stderr: The stderr output from the subprocess. This is only read
+          when the subprocess fails, and is empty otherwise.
     """
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return collections.namedtuple("CmdResult",
-        ["returncode", "stderr", "stdout"])(
-            p.returncode,
-            p.stderr.decode(encoding).strip(),
-            p.stdout.decode(encoding).strip())
+    # This is only needed when running a command, so it is imported lazily
+    import tempfile
+    with tempfile.TemporaryFile() as err:
+        # On Windows, the handles that are inherited by the subprocess do not
+        # need to be restricted since Python creates them non-inheritable
+        p = subprocess.run(cmd, stderr=err, close_fds=(PLATFORM != "windows"))
+        stderr = ""
+        if p.returncode:
+            err.seek(0)
+            stderr = err.read().decode(encoding, errors="replace").strip()
+    return CmdResult(p.returncode, stderr)
 
 def default_handler(args):
     """
     The default argument handler. This prints some information about the
     program.
     """
-    c = read_config()
-    for k in sorted(c):
-        print(f"{k}: {c[k]}")
+    for k in sorted(args.config):
+        print(f"{k}: {args.config[k]}")
 
 def vivado_tcl(script_name, exit_code):
     """
@@ -166,9 +491,13 @@ def vivado_tcl(script_name, exit_code):
     if (r is not None and r.returncode) or e is not None:
         if e is not None:
             printerr(f"Exception: {e}")
+        # Vivado reports most errors on stdout, which has already been shown,
+        # so stderr is often empty
         if r is not None:
-            printerr(f"Error (stderr): {r.stderr}")
-            printerr(f"Error (stdout): {r.stdout}")
+            printerr(f"Error: {args.vivado_path} exited with code "
+                    f"{r.returncode}")
+            if r.stderr:
+                printerr(f"Error (stderr): {r.stderr}")
         sys.exit(exit_code)
 
 def checkin_handler(args):
@@ -206,6 +535,7 @@ def parse_args():
     A named tuple with the following fields:
         - func (Fn<Args>): The function to run with the args for a supplied
           subcommand.
+        - config (dict): The configuration read from the config files.
         - repo_path (str): The path to the repo to generate the project.
         - script_dir (str): The path to the directory which contains the Tcl
           scripts.
@@ -229,6 +559,7 @@ def parse_args():
     p.set_defaults(workspace_path=DEFAULT_WORKSPACE_PATH)
     p.set_defaults(xpr_path=DEFAULT_XPR_PATH)
     p.set_defaults(vivado_version=DEFAULT_VIVADO_VERSION)
+    p.set_defaults(sdk=False)
     p.set_defaults(func=default_handler)
     sp = p.add_subparsers()
     # Checkin arguments
@@ -251,17 +582,16 @@ def parse_args():
     pout.set_defaults(func=checkout_handler)
     # Parse the arguments
     args = p.parse_args()
-    return collections.namedtuple("Args",
-        ["func", "project_name", "repo_path", "script_dir", "vivado_path",
-                "vivado_version", "workspace_path", "xpr_path", "sdk"])(
+    return Args(
             args.func,
+            c,
             PROJECT_NAME,
-            os.path.abspath(args.repo_path.replace("\\", "/")),
+            abs_path(args.repo_path),
             os.path.dirname(os.path.abspath(__file__)),
             args.vivado_path.replace("\\", "/"),
             args.vivado_version,
             args.workspace_path,
-            os.path.abspath(args.xpr_path.replace("\\", "/")),
+            abs_path(args.xpr_path),
             args.sdk,
         )
 